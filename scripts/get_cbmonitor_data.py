@@ -1,4 +1,4 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 
 '''
 Copyright 2018 Couchbase, Inc
@@ -20,80 +20,139 @@ some performance metrics to file (JSON and CSV formats).
 
 Usage: get_cbmonitor_data.py --job-list \
        <project1>:<number1>[:'<label1>'] [<project2>:<number2> ..] \
-       --output-dir <output_dir>
+       --output-dir <output_dir> [--no-cache]
 (e.g., get_cbmonitor_data.py --job-list \
        hera-pl:60:'RocksDB low OPS' hera-pl:67 --output_dir . )
+
+The downloaded cbmonitor data is cached on disk (cbmonitor_cache.sqlite, in
+the current directory), use --no-cache to always download it.
 '''
 
 import argparse
 import collections
+from concurrent.futures import ThreadPoolExecutor
 import csv
-import gzip
 import json
 import numpy
 import re
-from StringIO import StringIO
+import requests
+from requests.adapters import HTTPAdapter
 import sys
-import urllib2
+import threading
+from urllib3.util.retry import Retry
+
+# orjson is much faster than the standard json module, use it if available.
+# Note: jsonDumps always returns bytes
+try:
+    import orjson
+    jsonLoads = orjson.loads
+    jsonDumps = orjson.dumps
+except ImportError:
+    jsonLoads = json.loads
 
+    def jsonDumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
-# data format: [[timestamp1,value1],[timestamp2,value2],..]
-def downloadData(url):
-    print("downloading: " + url)
+
+# Jobs are processed concurrently: the lines of each job are buffered (see
+# process_job) and written as a single block once the job is done, the lock
+# stops two blocks from being written over each other
+printLock = threading.Lock()
+
+
+def log(message):
+    with printLock:
+        print(message)
+
+
+# Shared by all the jobs, so that the number of concurrent downloads stays
+# bounded (and within the connection pool size) however many jobs run
+downloadPool = ThreadPoolExecutor(max_workers=16)
+
+
+# 'jobLog' is the function used to log the lines of the job the url belongs to
+def openUrl(url, jobLog, stream=False):
     try:
-        # Note: urllib2 module sends HTTP/1.1 requests with Connection:close
-        # header included
-        request = urllib2.Request(url)
-        request.add_header('Accept-encoding', 'gzip')
-        response = urllib2.urlopen(request, timeout=10)
-    except urllib2.URLError, e:
-        raise Exception("'urlopen' error, url not correct or user not "
+        response = session.get(url, timeout=10, stream=stream)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise Exception("'get' error, url not correct or user not "
                         "connected to VPN: %r" % e)
-
-    if response.info().get('Content-Encoding') == 'gzip':
-        buf = StringIO(response.read())
-        f = gzip.GzipFile(fileobj=buf)
-        return f.read()
+    # Note: only the responses of a CachedSession have 'from_cache'
+    if getattr(response, "from_cache", False):
+        jobLog("cached: " + url)
     else:
-        return response.read()
+        jobLog("downloading: " + url)
+    return response
 
 
-def getAverage(url):
-    accumulator = 0.0
-    pairs = json.loads(downloadData(url))
-    for pair in pairs:
-        accumulator += float(pair[1])
-    return accumulator/len(pairs)
+# Used for the job console log and the dataset listings
+def downloadData(url, jobLog):
+    return openUrl(url, jobLog).text
 
 
-def getAverageFromList(urls, per_single_node):
+# data format: [[timestamp1,value1],[timestamp2,value2],..]
+# Only the values are kept, as a numpy array.
+# Note: the same array is shared by all the reducers of a metric (e.g.,
+# average and max), so it is made read-only
+def fetchValues(url, jobLog):
+    if streamSeries:
+        # Parse the body as it is received, so that neither the raw body nor
+        # the full list of pairs are ever held in memory
+        with openUrl(url, jobLog, stream=True) as response:
+            # The raw stream is not decompressed by default
+            response.raw.decode_content = True
+            pairs = ijson.items(response.raw, "item", use_float=True)
+            values = numpy.fromiter((pair[1] for pair in pairs),
+                                    dtype=numpy.float64)
+    else:
+        # The whole body is in memory already, just parse it in one go
+        pairs = jsonLoads(openUrl(url, jobLog).content)
+        values = numpy.ascontiguousarray(
+            numpy.asarray(pairs, dtype=numpy.float64).reshape(-1, 2)[:, 1])
+    values.flags.writeable = False
+    return values
+
+
+def prefetch(urls, jobLog):
+    # The downloads are I/O-bound, so issue them concurrently and return a
+    # map {url: values}.
+    # Note: duplicates are removed preserving the order of the urls, so that
+    # each metric is downloaded and parsed only once
+    urls = list(dict.fromkeys(urls))
+    return dict(zip(urls,
+                    downloadPool.map(lambda url: fetchValues(url, jobLog),
+                                     urls)))
+
+
+# Note: all the reducers multiply the result by 'scale' and divide it by
+# 'divisor', to convert it to the desired unit. Use 'divisor' rather than a
+# fractional 'scale' for divisions (e.g., us -> ms), x/1000 and x*0.001 do not
+# always round the same way
+def getAverage(values, scale=1.0, divisor=1.0):
+    return values.mean() * scale / divisor
+
+
+def getAverageFromList(valuesList, per_single_node, scale=1.0, divisor=1.0):
     accumulator = 0.0
-    for url in urls:
-        accumulator += getAverage(url)
-    return (accumulator/len(urls) if per_single_node else accumulator)
+    for values in valuesList:
+        accumulator += getAverage(values)
+    return ((accumulator/len(valuesList) if per_single_node else accumulator) *
+            scale / divisor)
 
 
-def getMax(url):
-    maximum = 0.0
-    pairs = json.loads(downloadData(url))
-    for pair in pairs:
-        value = float(pair[1])
-        if value > maximum:
-            maximum = value
-    return maximum
+def getMax(values, scale=1.0, divisor=1.0):
+    # Note: the max of an empty (or all-negative) series is 0
+    return values.max(initial=0.0) * scale / divisor
 
 
-def getP99(url):
-    valueList = []
-    pairs = json.loads(downloadData(url))
-    for pair in pairs:
-        valueList.append(float(pair[1]))
-    return numpy.percentile(valueList, 99.0)
+def getP99(values, scale=1.0, divisor=1.0):
+    return numpy.percentile(values, 99.0) * scale / divisor
 
 
 usage = ("Usage: get_cbmonitor_data.py --job-list "
          "<project1>:<number1>[:'<label1>'] [<project2>:<number2> ..] "
-         "--output-dir <output_dir> "
+         "--output-dir <output_dir> [--no-cache]"
          "\n\t(e.g., get_cbmonitor_data.py --job-list "
          "hera-pl:60:'RocksDB low OPS' hera-pl:67 hera-pl:83 --output-dir . )")
 
@@ -102,6 +161,7 @@ ap = argparse.ArgumentParser()
 try:
     ap.add_argument('--job-list', nargs='+')
     ap.add_argument('--output-dir')
+    ap.add_argument('--no-cache', action='store_true')
 except:
     print(usage)
     sys.exit()
@@ -118,60 +178,119 @@ output_dir = args.output_dir
 print("Job list: " + str(job_list))
 print("Output dir: " + output_dir)
 
+# A single session is shared by all the downloads so that the TCP connections
+# to the same host are kept alive and reused across metrics and jobs.
+# The cbmonitor data of a snapshot never changes once the run has completed
+# (and the snapshot name is part of every url), so unless disabled the
+# responses are cached on disk and re-running the script for the same jobs
+# does not download them again. The Jenkins console log is never cached, as
+# it changes while the job runs.
+# Note: the body is requested gzip-compressed, the console log in particular
+# compresses very well. requests decodes it transparently
+if args.no_cache:
+    session = requests.Session()
+    # The metric series are parsed as they are received.
+    # Note: ijson is only needed (and so only imported) in this case
+    import ijson
+    streamSeries = True
+else:
+    # Only needed (and so only imported) if caching is enabled
+    import requests_cache
+    session = requests_cache.CachedSession(
+        "cbmonitor_cache", backend="sqlite",
+        expire_after=requests_cache.NEVER_EXPIRE,
+        urls_expire_after={
+            "perf.jenkins.couchbase.com": requests_cache.DO_NOT_CACHE})
+    # The cached session reads (and stores) the whole body of every
+    # response, so there is no point in streaming the metric series
+    streamSeries = False
+session.headers["Accept-Encoding"] = "gzip"
+# Transient errors (e.g., a Jenkins/cbmonitor hiccup) are retried with an
+# exponential backoff rather than aborting the whole run
+retry = Retry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+
+byteToMBConversionFactor = numpy.float64(1.0/(1024*1024))
+sToMsConversionFactor = numpy.float64(1000)
+usToMsConversionDivisor = numpy.float64(1000)
+
+'''
+Regex to get, in a single pass over the job console log:
+ - the snapshot name, from e.g.:
+        ... snapshot=<snapshot>
+ - the nodes IP, from e.g.:
+        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.100
+        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.101
+        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.102
+        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.103
+ - the bucket name, from e.g.:
+        2018-01-16T09:19:17 [INFO] Adding new bucket: bucket-1
+ - whether the 'spring_latency' dataset has been collected
+'''
+consoleRegex = re.compile(r"snapshot=(?P<snapshot>[^=\s]*)"
+                          r"|Getting memcached port from(?P<node>.*)"
+                          r"|Adding new bucket[^:\n]*:(?P<bucket>[^:\n]*)"
+                          r"|(?P<latency>spring_latency)")
 
-byteToMBConversionFactor = 1.0/(1024*1024)
 host = "http://cbmonitor.sc.couchbase.com:8080"
 
-# Keep data for all jobs to build an aggregated CSV file
-data_list = []
-# Main loop
 for job in job_list:
-    print("**************************************")
-    print("Job: " + job)
-    print("**************************************")
-
-    array = job.split(":")
-    if len(array) < 2:
+    if len(job.split(":")) < 2:
         print(usage)
         sys.exit()
-    project = array[0]
-    number = array[1]
-    label = array[2] if (len(array) == 3) else ""
 
-    consoleText = downloadData("http://perf.jenkins.couchbase.com/job/" +
-                               project + "/" + number + "/consoleText")
 
-    if consoleText.find("snapshot=") == -1:
-        print("Snapshot not found for job" + job + ", probably the job has "
-              "been aborted. Skipping..")
-        continue
-    snapshot = re.search("snapshot=.*", consoleText).group(0).split("=")[1]
-    print("snapshot: " + snapshot)
+# Returns the data for the given <project>:<number> job (without the 'job' and
+# 'label' fields), None if the job has to be skipped
+def process_job(job):
+    lines = []
+    try:
+        return getJobData(job, lines.append)
+    finally:
+        log("\n".join(lines))
 
-    '''
-    Regex to get nodes IP from e.g.:
-        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.100
-        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.101
-        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.102
-        2018-01-16T11:35:11 [INFO] Getting memcached port from 172.23.96.103
-    '''
-    memcachedMatchAll = re.findall("Getting memcached port from.*",
-                                   consoleText)
-    nodes = []
-    for match in memcachedMatchAll:
-        nodes.append(match.split("from")[1].strip().replace(".", ""))
-    nodes = set(nodes)
-    print("nodes: " + str(nodes))
-
-    '''
-    Regex to get bucket name from e.g.:
-        2018-01-16T09:19:17 [INFO] Adding new bucket: bucket-1
-    '''
-    bucket = re.search("Adding new bucket.*", consoleText) \
-        .group(0) \
-        .split(":")[1] \
-        .strip()
-    print("bucket: " + bucket)
+
+def getJobData(job, jobLog):
+    jobLog("**************************************\n" +
+           "Job: " + job + "\n" +
+           "**************************************")
+
+    project, number = job.split(":")
+
+    consoleText = downloadData("http://perf.jenkins.couchbase.com/job/" +
+                               project + "/" + number + "/consoleText",
+                               jobLog)
+
+    snapshot = None
+    nodes = set()
+    bucket = None
+    hasLatency = False
+    for match in consoleRegex.finditer(consoleText):
+        if match.lastgroup == "snapshot":
+            if snapshot is None:
+                snapshot = match.group("snapshot")
+        elif match.lastgroup == "node":
+            nodes.add(match.group("node").strip().replace(".", ""))
+        elif match.lastgroup == "bucket":
+            if bucket is None:
+                bucket = match.group("bucket").strip()
+        else:
+            hasLatency = True
+
+    if snapshot is None:
+        jobLog("Snapshot not found for job" + job + ", probably the job has "
+               "been aborted. Skipping..")
+        return None
+    jobLog("snapshot: " + snapshot)
+
+    # Sorted, so that the urls are always requested in the same order
+    nodes = sorted(nodes)
+    jobLog("nodes: " + str(nodes))
+
+    jobLog("bucket: " + bucket)
 
     # url format: [host + "/" + "<dataset>" + snapshot [+ "<ip/bucket>"] +
     #              "/" + "<resource>"]
@@ -186,107 +305,154 @@ for job in job_list:
     # other interesting timings
     avg_bg_wait_time = base_url_ns_server + "/avg_bg_wait_time"
     avg_disk_commit_time = base_url_ns_server + "/avg_disk_commit_time"
-    # read/write amplification
-    data_rps = []
-    data_wps = []
-    data_rbps = []
-    data_wbps = []
-    for node in nodes:
-        base_url_iostat = host + "/" + "iostat" + snapshot + node
-        data_rps.append(base_url_iostat + "/data_rps")
-        data_wps.append(base_url_iostat + "/data_wps")
-        data_rbps.append(base_url_iostat + "/data_rbps")
-        data_wbps.append(base_url_iostat + "/data_wbps")
     # disk amplification
     couch_total_disk_size = base_url_ns_server + "/couch_total_disk_size"
     # memory usage
-    base_url_atop = host + "/" + "atop" + snapshot
-    memcached_rss = []
-    for node in nodes:
-        memcached_rss.append(base_url_atop + node + "/memcached_rss")
     mem_used = base_url_ns_server + "/mem_used"
-    # cpu usage
-    memcached_cpu = []
+    # per-node metrics, as (metric_name, url):
+    #   - read/write amplification
+    #   - memory usage
+    #   - cpu usage
+    requests_plan = []
     for node in nodes:
-        memcached_cpu.append(base_url_atop + node + "/memcached_cpu")
+        base_url_iostat = host + "/" + "iostat" + snapshot + node
+        base_url_atop = host + "/" + "atop" + snapshot + node
+        for metric in ("data_rps", "data_wps", "data_rbps", "data_wbps"):
+            requests_plan.append((metric, base_url_iostat + "/" + metric))
+        for metric in ("memcached_rss", "memcached_cpu"):
+            requests_plan.append((metric, base_url_atop + "/" + metric))
 
     # Perfrunner collects the 'spring_latency' dataset for 'latency_set' and
     # 'latency_get' only on some test configs (i.e., synchronous clients)
     hasLatencySet = False
     hasLatencyGet = False
-    hasLatency = True if (consoleText.find("spring_latency") != -1) else False
     if hasLatency:
-        springLatency = downloadData(base_url_spring_latency)
+        springLatency = downloadData(base_url_spring_latency, jobLog)
         hasLatencySet = (True if (springLatency.find("latency_set") != -1)
                          else False)
         hasLatencyGet = (True if (springLatency.find("latency_get") != -1)
                          else False)
 
+    # Download all the metrics for this job in one batch
+    urls = [ops, avg_bg_wait_time, avg_disk_commit_time,
+            couch_total_disk_size, mem_used]
+    urls += [url for (metric, url) in requests_plan]
+    if hasLatencySet:
+        urls.append(latency_set)
+    if hasLatencyGet:
+        urls.append(latency_get)
+    series = prefetch(urls, jobLog)
+
+    node_series = collections.defaultdict(list)
+    for (metric, url) in requests_plan:
+        node_series[metric].append(series[url])
+
     data = collections.OrderedDict([
-        ('job', project + ":" + number),
-        ('label', label),
         ('snapshot', snapshot),
-        ('ops', '{:.2f}'.format(getAverage(ops))),
-        ('latency_set (ms)', '{:.2f}'.format(getAverage(latency_set))
+        ('ops', '{:.2f}'.format(getAverage(series[ops]))),
+        ('latency_set (ms)', '{:.2f}'.format(getAverage(series[latency_set]))
                             if hasLatencySet else 'N/A'),
-        ('latency_get (ms)', '{:.2f}'.format(getAverage(latency_get))
+        ('latency_get (ms)', '{:.2f}'.format(getAverage(series[latency_get]))
                             if hasLatencyGet else 'N/A'),
-        ('latency_set P99 (ms)', '{:.2f}'.format(getP99(latency_set))
+        ('latency_set P99 (ms)', '{:.2f}'.format(getP99(series[latency_set]))
                                 if hasLatencySet else 'N/A'),
-        ('latency_get P99 (ms)', '{:.2f}'.format(getP99(latency_get))
+        ('latency_get P99 (ms)', '{:.2f}'.format(getP99(series[latency_get]))
                                 if hasLatencyGet else 'N/A'),
-        ('avg_disk_commit_time (ms)', '{:.2f}'
-                                     .format(getAverage(avg_disk_commit_time) *
-                                             1000)),
-        ('avg_bg_wait_time (ms)', '{:.2f}'.format(getAverage(avg_bg_wait_time) /
-                                                 1000)),
-        ('avg_disk_commit_time P99 (ms)', '{:.2f}'
-                                     .format(getP99(avg_disk_commit_time) *
-                                             1000)),
-        ('avg_bg_wait_time P99 (ms)', '{:.2f}'.format(getP99(avg_bg_wait_time) /
-                                                     1000)),
-        ('data_rps (iops)', '{:.2f}'.format(getAverageFromList(data_rps, True))),
-        ('data_wps (iops)', '{:.2f}'.format(getAverageFromList(data_wps, True))),
+        ('avg_disk_commit_time (ms)', '{:.2f}'.format(
+                                getAverage(series[avg_disk_commit_time],
+                                           scale=sToMsConversionFactor))),
+        ('avg_bg_wait_time (ms)', '{:.2f}'.format(
+                                getAverage(series[avg_bg_wait_time],
+                                           divisor=usToMsConversionDivisor))),
+        ('avg_disk_commit_time P99 (ms)', '{:.2f}'.format(
+                                getP99(series[avg_disk_commit_time],
+                                       scale=sToMsConversionFactor))),
+        ('avg_bg_wait_time P99 (ms)', '{:.2f}'.format(
+                                getP99(series[avg_bg_wait_time],
+                                       divisor=usToMsConversionDivisor))),
+        ('data_rps (iops)', '{:.2f}'.format(
+                                getAverageFromList(node_series["data_rps"],
+                                                   True))),
+        ('data_wps (iops)', '{:.2f}'.format(
+                                getAverageFromList(node_series["data_wps"],
+                                                   True))),
         ('data_rbps (MB/s)', '{:.2f}'.format(
-                                        getAverageFromList(data_rbps, True) *
-                                        byteToMBConversionFactor
-                                     )),
+                                getAverageFromList(
+                                    node_series["data_rbps"], True,
+                                    scale=byteToMBConversionFactor))),
         ('data_wbps (MB/s)', '{:.2f}'.format(
-                                        getAverageFromList(data_wbps, True) *
-                                        byteToMBConversionFactor
-                                    )),
-        ('couch_total_disk_size (MB)', int(getAverage(couch_total_disk_size) *
-                                          byteToMBConversionFactor)),
-        ('max couch_total_disk_size (MB)', int(getMax(couch_total_disk_size) *
-                                              byteToMBConversionFactor)),
+                                getAverageFromList(
+                                    node_series["data_wbps"], True,
+                                    scale=byteToMBConversionFactor))),
+        ('couch_total_disk_size (MB)', int(
+                                getAverage(series[couch_total_disk_size],
+                                           scale=byteToMBConversionFactor))),
+        ('max couch_total_disk_size (MB)', int(
+                                getMax(series[couch_total_disk_size],
+                                       scale=byteToMBConversionFactor))),
         ('mem_used (MB)', '{:.2f}'.format(
-                                     getAverage(mem_used) *
-                                     byteToMBConversionFactor
-                                 )),
+                                getAverage(series[mem_used],
+                                           scale=byteToMBConversionFactor))),
         ('memcached_rss (MB, all nodes)', '{:.2f}'.format(
-                                          getAverageFromList(memcached_rss,
-                                                             False) *
-                                          byteToMBConversionFactor
-                                      )),
-        ('memcached_cpu', '{:.2f}'.format(getAverageFromList(memcached_cpu,
-                                                            True)))
+                                getAverageFromList(
+                                    node_series["memcached_rss"], False,
+                                    scale=byteToMBConversionFactor))),
+        ('memcached_cpu', '{:.2f}'.format(
+                                getAverageFromList(
+                                    node_series["memcached_cpu"], True)))
     ])
 
+    return data
+
+
+# Main loop, the jobs are independent from each other so process them
+# concurrently.
+# Note: a job may be given multiple times in the job list (e.g., with
+# different labels), each job is processed only once
+jobs = list(dict.fromkeys(":".join(job.split(":")[:2]) for job in job_list))
+with ThreadPoolExecutor(max_workers=min(len(jobs), 8)) as executor:
+    job_data = dict(zip(jobs, executor.map(process_job, jobs)))
+downloadPool.shutdown()
+
+# Keep data for all jobs (in the job list order) to build an aggregated CSV
+# file
+data_list = []
+# The JSON file of a job given multiple times gets the last label
+json_data = collections.OrderedDict()
+for job in job_list:
+    array = job.split(":")
+    project = array[0]
+    number = array[1]
+    label = array[2] if (len(array) == 3) else ""
+    if job_data[project + ":" + number] is None:
+        continue
+
+    data = collections.OrderedDict([
+        ('job', project + ":" + number),
+        ('label', label)
+    ])
+    data.update(job_data[project + ":" + number])
     data_list.append(data)
+    json_data[project + "-" + number] = data
 
-    # Write to JSON
-    json_file = output_dir + "/" + project + "-" + number + ".json"
+# Write to JSON
+for (name, data) in json_data.items():
+    json_file = output_dir + "/" + name + ".json"
     file = open(json_file, "wb")
-    file.write(json.dumps(data))
+    file.write(jsonDumps(data))
     file.close()
     print("Data written to " + json_file)
 
+if not data_list:
+    print("No data for any job, nothing to aggregate")
+    sys.exit()
+
 # Write to CSV
 csv_file = output_dir + "/" + "data.csv"
-file = open(csv_file, "wb")
-dictWriter = csv.DictWriter(file, data.keys())
+# Note: the csv module does its own newline handling
+file = open(csv_file, "w", newline="", buffering=1 << 20)
+dictWriter = csv.DictWriter(file, data_list[0].keys())
 dictWriter.writeheader()
-for data in data_list:
-    dictWriter.writerow(data)
+dictWriter.writerows(data_list)
 file.close()
 print("Aggregated data for all jobs written to " + csv_file)